@@ -17,14 +17,19 @@ meg = [7, 8, 9]
 trialgroups = [ant, james, meg]
 names = ['Ant', 'James', 'Megan']
 
+# bucket each trial into its corpus group, dropping the practice trial
+trial_group = {f'trial{i}': g for g in range(len(trialgroups)) for i in trialgroups[g]}
+df = df.assign(group=df['trial_id'].map(trial_group)) \
+    .dropna(subset=['group']).astype({'group': int})
+
+# number the responses within each (group, stimulus) so a single pivot
+# lays out every group's ratings as one column per stimulus
+df = df.assign(response=df.groupby(['group', 'rating_stimulus']).cumcount())
+pivot = df.pivot(index='response', columns=['group', 'rating_stimulus'], values='rating_score')
+
 trial_results: list[pd.DataFrame] = []
 for t in range(0,3):
-    trial_df = df.query(f'trial_id == "trial{trialgroups[t][0]}" | trial_id == "trial{trialgroups[t][1]}" | trial_id == "trial{trialgroups[t][2]}"')
-    newdf = pd.DataFrame()
-    for ref in audiorefs:
-        ref_results = trial_df.query(f'rating_stimulus == "{ref}"')['rating_score'].values
-        newdf.insert(0, ref, ref_results)
-    trial_results.append(newdf)
+    trial_results.append(pivot[t][audiorefs])
     plt.figure()
     boxplot = trial_results[t].boxplot(column=audiorefs)
     plt.ylim([-10, 110])
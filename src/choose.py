@@ -1,3 +1,6 @@
+import numpy as np
+from numba import njit
+
 from dataloader import PhonemeLoader, PhonemeMemLoader, strip_stress
 from phoneme import Phoneme, PhonemeInstance
 from typemes import Typeme
@@ -25,36 +28,44 @@ def choose_dual_similarity(voice: PhonemeLoader, typemes: Typeme, target: str, p
     falling back on intonation as a tiebreaker.
     """
     phoneme = voice.get_phoneme(target)
-    targ_pre = typemes[pre] if pre else None
-    targ_nex = typemes[nex] if nex else None
-
-    best_dual_similarity = float('-inf')
-    best_instance = None
-    # both_instance, pre_instance, nex_instance, none_instance = None, None, None, None
-    for instance in phoneme.instances:
-        dual_similarity = 0
-        
-        src_pre = typemes[instance.pre] if instance.pre else None
-        src_nex = typemes[instance.nex] if instance.nex else None
+    if len(phoneme) == 0:
+        return None
+    pre_ids, nex_ids, intonations = phoneme.context_arrays(typemes)
+    targ_pre, targ_nex = typemes.ids([pre, nex])
 
-        if targ_pre:
-            dual_similarity += targ_pre.similarity(src_pre)
-        if targ_nex:
-            dual_similarity += targ_nex.similarity(src_nex)
-        
-        if not best_instance or dual_similarity > best_dual_similarity or (
-                dual_similarity == best_dual_similarity and best_instance and \
-                best_instance and instance.intonation < best_instance.intonation):
-            best_dual_similarity = dual_similarity
-            best_instance = instance
+    best = best_dual_similarity(typemes.similarity_matrix(),
+        pre_ids, nex_ids, intonations, targ_pre, targ_nex)
+    return phoneme.instances[best]
 
-    targ_pre_name = '' if targ_pre == None else targ_pre.name
-    targ_nex_name = '' if targ_nex == None else targ_nex.name
-    src_pre_name = '' if instance.pre == None else instance.pre
-    src_nex_name = '' if instance.nex == None else instance.nex
+# compiled for the argument types Phoneme.context_arrays and Typeme
+# produce, on import or from the on-disk cache, not on first call
+@njit('int64(float32[:, :], int32[:], int32[:], float64[:], int32, int32)', cache=True)
+def best_dual_similarity(similarity: np.ndarray, pre_ids: np.ndarray, nex_ids: np.ndarray, intonations: np.ndarray,
+        targ_pre: int, targ_nex: int) \
+        -> int:
+    """
+    Returns the index of the source instance with the highest dual
+    similarity to the target context, where the lowest intonation
+    and then the lowest index break ties, in a single compiled pass.
+    similarity is as per Typeme.similarity_matrix and targ_pre,
+    targ_nex, pre_ids and nex_ids are as per Typeme.ids.
+    """
+    best = 0
+    best_score = -np.inf
+    best_intonation = np.nan
+    for i in range(len(pre_ids)):
+        score = 0.0
+        if targ_pre >= 0:
+            score += similarity[targ_pre, pre_ids[i]]
+        if targ_nex >= 0:
+            score += similarity[targ_nex, nex_ids[i]]
 
-    # print(f'sim=\t{best_dual_similarity}\t {src_pre_name}->{targ_pre_name} && {src_nex_name}->{targ_nex_name}')
-    return best_instance
+        # NaN intonations lose every tie, as they sort last
+        if score > best_score or (score == best_score
+                and (intonations[i] < best_intonation
+                     or (np.isnan(best_intonation) and not np.isnan(intonations[i])))):
+            best, best_score, best_intonation = i, score, intonations[i]
+    return best
 
 def choose_dual_equality(voice: PhonemeLoader, typemes: Typeme, target: str, pre: str = None, nex: str = None) \
         -> PhonemeInstance:
@@ -64,27 +75,8 @@ def choose_dual_equality(voice: PhonemeLoader, typemes: Typeme, target: str, pre
     intonation as a tiebreaker.
     """
     phoneme = voice.get_phoneme(target)
-
-    both_instance, pre_instance, nex_instance, none_instance = None, None, None, None
-    for instance in phoneme.instances:
-        if pre == instance.pre and nex == instance.nex:
-            if both_instance == None \
-                    or both_instance.intonation > instance.intonation:
-                both_instance = instance
-
-        elif pre == instance.pre:
-            if pre_instance == None \
-                    or pre_instance.intonation > instance.intonation:
-                pre_instance = instance
-
-        elif nex == instance.nex:
-            if nex_instance == None \
-                    or nex_instance.intonation > instance.intonation:
-                nex_instance = instance
-        else:
-            if none_instance == None \
-                    or none_instance.intonation > instance.intonation:
-                none_instance = instance
+    both_instance, pre_instance, nex_instance, none_instance = \
+        phoneme.equality_candidates(pre, nex)
 
     if both_instance != None:
         return both_instance
@@ -7,5 +7,7 @@ synth_config = {
 }
 
 metric_config = {
-    'f0_heuristic': 'peak_to_peak'
+    'f0_heuristic': 'peak_to_peak',
+    'f0_sample_rate': 8000,
+    'f0_cache': True,
 }
\ No newline at end of file
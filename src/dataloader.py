@@ -1,20 +1,141 @@
+import os
 import sys
+import json
 from pathlib import Path
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from functools import lru_cache
 
 import numpy as np
-import pickle
 import textgrids
-import librosa
+import soundfile as sf
 
 from phoneme import Phoneme, PhonemeInstance
-from intonation import f0_heuristic
+from intonation import f0_heuristic_batch
+from config import metric_config
 
+# errors raised on reading a malformed or unreadable TextGrid or wavfile
+GRID_ERRORS = (OSError, ValueError, TypeError, IndexError, textgrids.ParseError, textgrids.BinaryError)
+WAV_ERRORS = (OSError, sf.SoundFileError)
+
+# version of the saved voice layout written by PhonemeMemLoader.save,
+# to be bumped whenever that layout changes
+VOICE_STORE_VERSION = 1
+
+@lru_cache(maxsize=None)
 def strip_stress(name: str) \
         -> str:
+    """
+    Returns the phoneme name without its trailing stress digit, if any.
+    Memoised, since the same few dozen phoneme names recur throughout
+    every TextGrid and synthesised sentence.
+    Names are interned, so every occurrence of a phoneme shares one
+    string and context comparisons short-circuit on identity.
+    """
     if name == '' or name[-1] not in ['0', '1', '2', '3']:
-        return name
-    return name[:-1]
+        return sys.intern(str(name))
+    return sys.intern(str(name[:-1]))
+
+def interval_bounds(tier: textgrids.Tier, sr: int) \
+        -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the start and end sample indices of every interval
+    in a TextGrid tier as a pair of int64 vectors.
+    """
+    xmins = np.array([grid_i.xmin for grid_i in tier], dtype=np.float64)
+    xmaxs = np.array([grid_i.xmax for grid_i in tier], dtype=np.float64)
+    return (sr * xmins).astype(np.int64), (sr * xmaxs).astype(np.int64)
+
+def read_wav(wav_file: str) \
+        -> tuple[np.ndarray, int]:
+    """
+    Decodes a wavfile to a mono float32 waveform at its native
+    sampling rate.
+    """
+    wav, sr = sf.read(wav_file, dtype='float32', always_2d=True)
+    return wav.mean(axis=1), sr
+
+# decoded wavfiles by path, least recently used first
+WAV_CACHE_SIZE = 256
+_wav_cache: OrderedDict[str, tuple[np.ndarray, int]] = OrderedDict()
+
+def _load_wav(wav_file: str) \
+        -> tuple[np.ndarray, int]:
+    """
+    read_wav, cached by path so repeated queries for the same
+    word do not touch the disk again. Keeps the WAV_CACHE_SIZE
+    most recently used wavfiles.
+    """
+    cached = _cached_wav(wav_file)
+    if cached != None:
+        return cached
+
+    _wav_cache[wav_file] = read_wav(wav_file)
+    if len(_wav_cache) > WAV_CACHE_SIZE:
+        _wav_cache.popitem(last=False)
+    return _wav_cache[wav_file]
+
+def _cached_wav(wav_file: str) \
+        -> tuple[np.ndarray, int] | None:
+    """
+    Returns the decode of wav_file held by _load_wav,
+    or None if it is not cached, without decoding it.
+    """
+    cached = _wav_cache.get(wav_file)
+    if cached != None:
+        _wav_cache.move_to_end(wav_file)
+    return cached
+
+def _find_pairs(phoneme_path: Path) \
+        -> list[tuple[Path, Path]]:
+    """
+    Returns a (TextGrid path, wavfile path) pair for every TextGrid
+    in phoneme_path with a matching wavfile, sorted by stem.
+    The directory is listed once rather than stat-ing each wavfile.
+    """
+    with os.scandir(phoneme_path) as entries:
+        names = {entry.name for entry in entries}
+
+    pairs = []
+    for name in sorted(names):
+        if not name.endswith('.TextGrid'):
+            continue
+
+        wav_name = f'{name[:-len(".TextGrid")]}.wav'
+        if wav_name not in names:
+            print(f'Warning: {wav_name} does not exist')
+            continue
+        pairs.append((phoneme_path.joinpath(name), phoneme_path.joinpath(wav_name)))
+
+    return pairs
+
+def _load_pair(grid_file: Path, wav_file: Path) \
+        -> tuple[tuple[np.ndarray, int], textgrids.TextGrid, list[float]] | str:
+    """
+    Loads one TextGrid and wavfile pair and estimates the intonation
+    of every phonetic interval. Returns the following data tuple:
+    (
+      (waveform vector, sampling rate),
+      TextGrid,
+      list of intonations indexed by interval
+    )
+    Returns a warning message instead if either file cannot be
+    loaded, for the caller to print, so that worker processes
+    never write to the terminal themselves.
+    """
+    try:
+        grid = textgrids.TextGrid(grid_file)
+    except GRID_ERRORS:
+        return f'Warning: Could not open {grid_file.name} as TextGrid'
+
+    try:
+        wav, sr = read_wav(str(wav_file))
+    except WAV_ERRORS:
+        return f'Warning: Could not load {grid_file.name} as WAV'
+
+    wav_starts, wav_ends = interval_bounds(grid['phonetic'], sr)
+    return ((wav, sr), grid, f0_heuristic_batch(wav, sr, wav_starts, wav_ends, None, wav_file))
 
 class PhonemeLoader(ABC):
     """
@@ -53,6 +174,31 @@ class PhonemeLoader(ABC):
         """
         pass
 
+    def get_grid(self, word: str) \
+            -> textgrids.TextGrid:
+        """
+        Returns the TextGrid for the queried word.
+        """
+        return self.grid_dict[word][1]
+
+    def get_interval_bounds(self, word: str) \
+            -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the start and end sample indices of every phonetic
+        interval of the queried word, as per interval_bounds.
+        """
+        return self.bounds_dict[word]
+
+    @abstractmethod
+    def get_wav_segment(self, word: str, xmin: float, xmax: float) \
+            -> tuple[np.ndarray, int]:
+        """
+        Returns the following data tuple for the queried word
+        between times xmin and xmax (in seconds):
+        (waveform vector, sampling rate)
+        """
+        pass
+
     def get_phoneme(self, name: str) \
             -> Phoneme:
         """
@@ -80,15 +226,11 @@ class PhonemeLoader(ABC):
         data = []
 
         for instance in phoneme.instances:
-            (wav, sr), grid = self.get_word_data(instance.word)
-
-            grid_i = grid['phonetic'][instance.interval]
-            wav_start = int(np.floor(sr * grid_i.xmin))
-            wav_end = int(np.floor(sr * grid_i.xmax))
+            grid_i = self.get_grid(instance.word)['phonetic'][instance.interval]
 
             data.append((
                 instance,
-                (wav[wav_start:wav_end], sr),
+                self.get_wav_segment(instance.word, grid_i.xmin, grid_i.xmax),
                 grid_i
             ))
 
@@ -111,46 +253,45 @@ class PhonemeDiskLoader(PhonemeLoader):
 
         self.voice = phoneme_path.stem
         self.grid_dict = {}
+        self.bounds_dict = {}
         self.phoneme_dict = {}
 
-        grid_files = sorted(phoneme_path.glob("*.TextGrid"))
-        for grid_file in grid_files:
+        for grid_file, wav_file in _find_pairs(phoneme_path):
             stem = grid_file.stem
 
-            wav_file = phoneme_path.joinpath(Path(f'{stem}.wav'))
-            if not wav_file.exists():
-                print(f'Warning: {wav_file.name} does not exist')
-                continue
-
             try:
                 grid = textgrids.TextGrid(grid_file)
-            except:
+            except GRID_ERRORS:
                 print(f'Warning: Could not open {grid_file.name} as TextGrid')
                 continue
 
+            # decode through the same cache get_word_data reads from,
+            # so the first query for this word does not decode it again
             try:
-                wav, sr = librosa.load(wav_file, sr=None, mono=True)
-            except:
+                wav, sr = _load_wav(str(wav_file))
+            except WAV_ERRORS:
                 print(f'Warning: Could not load {grid_file.name} as WAV')
                 continue
 
             self.grid_dict[stem] = (str(wav_file), grid)
 
-            pre = None
-            for interval in range(len(grid['phonetic'])):
-                grid_i = grid['phonetic'][interval]
-                name = strip_stress(grid_i.text)
+            phon_tier = grid['phonetic']
 
-                wav_start = int(np.floor(sr * grid_i.xmin))
-                wav_end = int(np.floor(sr * grid_i.xmax))
+            wav_starts, wav_ends = interval_bounds(phon_tier, sr)
+            self.bounds_dict[stem] = (wav_starts, wav_ends)
+            intonations = f0_heuristic_batch(wav, sr, wav_starts, wav_ends, None, wav_file)
 
-                intonation = f0_heuristic(wav[wav_start:wav_end], sr, None)
+            pre, prev_instance = None, None
+            for interval, grid_i in enumerate(phon_tier):
+                name = strip_stress(grid_i.text)
+                intonation = intonations[interval]
 
-                if (name not in self.phoneme_dict):
-                    self.phoneme_dict[name] = Phoneme(name, [])
+                phoneme = self.phoneme_dict.get(name)
+                if phoneme == None:
+                    phoneme = self.phoneme_dict[name] = Phoneme(name, [])
 
                 instance = PhonemeInstance(
-                    self.phoneme_dict[name],
+                    phoneme,
                     stem,
                     interval,
                     intonation,
@@ -158,11 +299,13 @@ class PhonemeDiskLoader(PhonemeLoader):
                     nex=None
                 )
 
-                self.phoneme_dict[name].append(instance)
+                phoneme.append(instance)
 
-                if pre != None:
-                    (self.phoneme_dict[pre][stem, interval-1]).nex = self.phoneme_dict[name][stem, interval]
+                if prev_instance != None:
+                    prev_instance.nex = instance
+                    prev_instance.phoneme.invalidate()
                 pre = name
+                prev_instance = instance
 
 
         self.num_phonemes = len(self.phoneme_dict)
@@ -170,10 +313,39 @@ class PhonemeDiskLoader(PhonemeLoader):
 
     def get_word_data(self, word: str) -> tuple[tuple[np.ndarray, int], textgrids.TextGrid]:
         (wav_file, grid) = self.grid_dict[word]
-        wav, sr = librosa.load(wav_file, sr=None, mono=True)
+        wav, sr = _load_wav(wav_file)
 
         return ((wav, sr), grid)
 
+    def get_wav_segment(self, word: str, xmin: float, xmax: float) \
+            -> tuple[np.ndarray, int]:
+        (wav_file, grid) = self.grid_dict[word]
+
+        # slice the decode cached by __init__ and get_word_data if it
+        # is still held, so repeated segments never touch the disk
+        cached = _cached_wav(wav_file)
+        if cached != None:
+            wav, sr = cached
+            return (wav[int(sr * xmin):int(sr * xmax)], sr)
+
+        # otherwise seek to and decode only the requested frames,
+        # clamping to the file as slicing a decoded wav would
+        with sf.SoundFile(wav_file) as f:
+            sr = f.samplerate
+            wav_start = min(int(sr * xmin), f.frames)
+            wav_end = min(max(int(sr * xmax), wav_start), f.frames)
+
+            f.seek(wav_start)
+            wav = f.read(wav_end - wav_start, dtype='float32', always_2d=True)
+
+        return (wav.mean(axis=1), sr)
+
+    def cache_clear(self):
+        """
+        Drops all decoded wavfiles held in memory.
+        """
+        _wav_cache.clear()
+
 class PhonemeMemLoader(PhonemeLoader):
     """
     PhonemeMemLoader class (PhonemeLoader with wavfiles stored in-memory)
@@ -191,63 +363,158 @@ class PhonemeMemLoader(PhonemeLoader):
 
         self.voice = phoneme_path.stem
         self.grid_dict = {}
+        self.bounds_dict = {}
         self.phoneme_dict = {}
-
-        grid_files = sorted(phoneme_path.glob("*.TextGrid"))
-        for grid_file in grid_files:
-            stem = grid_file.stem
-
-            wav_file = phoneme_path.joinpath(Path(f'{stem}.wav'))
-            if not wav_file.exists():
-                print(f'Warning: {wav_file.name} does not exist')
-                continue
-
-            try:
-                grid = textgrids.TextGrid(grid_file)
-            except:
-                print(f'Warning: Could not open {grid_file.name} as TextGrid')
-                continue
-
-            try:
-                wav, sr = librosa.load(wav_file, sr=None, mono=True)
-            except:
-                print(f'Warning: Could not load {grid_file.name} as WAV')
-                continue
-
-            pre = None
-            self.grid_dict[stem] = ((wav, sr), grid)
-            for interval in range(len(grid['phonetic'])):
-                grid_i = grid['phonetic'][interval]
-                name = str(strip_stress(grid_i.text))
-
-                wav_start = int(np.floor(sr * grid_i.xmin))
-                wav_end = int(np.floor(sr * grid_i.xmax))
-
-                intonation = f0_heuristic(wav[wav_start:wav_end], sr, None)
-
-                if (name not in self.phoneme_dict):
-                    self.phoneme_dict[name] = Phoneme(name, [])
-
-                instance = PhonemeInstance(
-                    self.phoneme_dict[name],
-                    stem,
-                    interval,
-                    intonation,
-                    pre='' if not pre else pre,
-                    nex=''
-                )
-
-                self.phoneme_dict[name].append(instance)
-
-                if pre != None:
-                    (self.phoneme_dict[pre][stem, interval-1]).nex = name
-                pre = name
+        self._intonations = {}
+        self._wavs = {}
+
+        pairs = _find_pairs(phoneme_path)
+
+        # decoding and f0 estimation are independent per file and mostly
+        # GIL-bound, so fan them out to worker processes and keep only
+        # the phoneme_dict linking pass serial
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            loaded = executor.map(_load_pair,
+                [grid_file for grid_file, _ in pairs],
+                [wav_file for _, wav_file in pairs])
+
+            for (grid_file, _), pair_data in zip(pairs, loaded):
+                if isinstance(pair_data, str):
+                    print(pair_data)
+                    continue
+                (wav, sr), grid, intonations = pair_data
+                self._add_word(grid_file.stem, wav, sr, grid, intonations)
 
         self.num_phonemes = len(self.phoneme_dict)
         print(f'Loaded {len(self.grid_dict)} wavfile and textgrid pairs from {phoneme_subpath}')
 
+    def _add_word(self, stem: str, wav: np.ndarray, sr: int, grid: textgrids.TextGrid, intonations: list[float]):
+        """
+        Stores one word and links an instance of every phoneme
+        in its phonetic tier into phoneme_dict.
+        """
+        pre, prev_instance = None, None
+        self.grid_dict[stem] = (sr, grid)
+        self._intonations[stem] = intonations
+        self._wavs[stem] = wav
+        phon_tier = grid['phonetic']
+        self.bounds_dict[stem] = interval_bounds(phon_tier, sr)
+        for interval, grid_i in enumerate(phon_tier):
+            name = str(strip_stress(grid_i.text))
+            intonation = intonations[interval]
+
+            phoneme = self.phoneme_dict.get(name)
+            if phoneme == None:
+                phoneme = self.phoneme_dict[name] = Phoneme(name, [])
+
+            instance = PhonemeInstance(
+                phoneme,
+                stem,
+                interval,
+                intonation,
+                pre='' if not pre else pre,
+                nex=''
+            )
+
+            phoneme.append(instance)
+
+            if prev_instance != None:
+                prev_instance.nex = name
+                prev_instance.phoneme.invalidate()
+            pre = name
+            prev_instance = instance
+
+    def save(self, store_path: str):
+        """
+        Writes the loaded voice to store_path.npy, holding every
+        waveform back to back in one float32 vector, and
+        store_path.json, holding each word's offset into it and the
+        TextGrid intervals and intonations needed to relink it,
+        tagged with VOICE_STORE_VERSION and the intonation settings.
+        """
+        words = {}
+        wavs = []
+        offset = 0
+        for stem, (sr, grid) in self.grid_dict.items():
+            wav = self._wavs[stem]
+            words[stem] = {
+                'sr': sr,
+                'offset': offset,
+                'length': len(wav),
+                'tiers': {tier_name: grid.interval_tier_to_array(tier_name)
+                          for tier_name, tier in grid.items() if not tier.is_point_tier},
+                'intonations': self._intonations[stem]
+            }
+            wavs.append(wav)
+            offset += len(wav)
+
+        # write beside the saved voice and rename over it, as the
+        # waveforms being saved may be mapped from that very file
+        wav_tmp = f'{store_path}.{os.getpid()}.npy'
+        np.save(wav_tmp, np.concatenate([np.empty(0, dtype=np.float32), *wavs]))
+        os.replace(wav_tmp, f'{store_path}.npy')
+        with open(f'{store_path}.json', 'w') as meta_file:
+            json.dump({
+                'version': VOICE_STORE_VERSION,
+                'f0_heuristic': metric_config['f0_heuristic'],
+                'f0_sample_rate': metric_config['f0_sample_rate'],
+                'voice': self.voice,
+                'words': words
+            }, meta_file)
+
+    @classmethod
+    def load(cls, store_path: str) \
+            -> 'PhonemeMemLoader':
+        """
+        Returns the PhonemeMemLoader written by save to store_path,
+        without decoding any wavfile or estimating any intonation.
+        Raises ValueError if it was saved by another version or with
+        other intonation settings in config.py.
+        Waveforms are memory-mapped, so only the samples actually
+        sliced out of them are ever read from disk.
+        """
+        with open(f'{store_path}.json', 'r') as meta_file:
+            meta = json.load(meta_file)
+
+        # stored intonations are only valid for the layout and
+        # intonation settings they were saved with
+        if meta.get('version') != VOICE_STORE_VERSION:
+            raise ValueError(f'{store_path}.json is not a version {VOICE_STORE_VERSION} saved voice')
+        if meta['f0_heuristic'] != metric_config['f0_heuristic'] \
+                or meta['f0_sample_rate'] != metric_config['f0_sample_rate']:
+            raise ValueError(f'{store_path}.json was saved with different intonation settings')
+
+        voice = cls.__new__(cls)
+        voice.voice = meta['voice']
+        voice.grid_dict = {}
+        voice.bounds_dict = {}
+        voice.phoneme_dict = {}
+        voice._intonations = {}
+        voice._wavs = {}
+
+        wavs = np.load(f'{store_path}.npy', mmap_mode='r')
+        for stem, word in meta['words'].items():
+            grid = textgrids.TextGrid()
+            for tier_name, array in word['tiers'].items():
+                grid.interval_tier_from_array(tier_name, array)
+            wav = wavs[word['offset']:word['offset'] + word['length']]
+            voice._add_word(stem, wav, word['sr'], grid, word['intonations'])
+
+        voice.num_phonemes = len(voice.phoneme_dict)
+        return voice
+
     def get_word_data(self, word: str) -> tuple[tuple[np.ndarray, int], textgrids.TextGrid]:
-        return self.grid_dict[word]
+        sr, grid = self.grid_dict[word]
+        return ((self._wavs[word], sr), grid)
+
+    def get_wav_segment(self, word: str, xmin: float, xmax: float) \
+            -> tuple[np.ndarray, int]:
+        sr, grid = self.grid_dict[word]
+        wav = self._wavs[word]
+        wav_start = int(sr * xmin)
+        wav_end = int(sr * xmax)
+
+        return (wav[wav_start:wav_end], sr)
 
 if __name__ == '__main__':
     if len(sys.argv) < 2 or len(sys.argv) > 3 :
@@ -255,46 +522,40 @@ if __name__ == '__main__':
         print('  VOICE: voice with WAV, TextGrid data in data/')
         print('  PHONEME: phoneme to observe data for')
         print('Pass a PHONEME to query the cached data.')
-        print('Pass no PHONEME to reload and repickle the data.')
+        print('Pass no PHONEME to reload and resave the data.')
         exit(-1)
 
     voice_name = sys.argv[1]
+    # the voice directory path doubles as the prefix of its saved voice
     root_path = Path(__file__).parent.parent.resolve()
-    voice_path = root_path.joinpath(Path(f'data/{voice_name}'))
-    pickle_path = root_path.joinpath(Path(f'data/{voice_name}.pickle'))
+    voice_path = store_path = root_path.joinpath('data', voice_name)
 
     if len(sys.argv) == 2:
-        print('=== PhonemeLoader repickle ==============')
+        print('=== PhonemeLoader resave ================')
         voice = PhonemeMemLoader(voice_path)
         all_phonemes = voice.list_phonemes()
         print(f'{len(all_phonemes)} phonemes found: {all_phonemes}')
         try:
-            pickle_file = open(pickle_path, 'wb')
-            pickle.dump(voice, pickle_file)
-            pickle_file.close()
-            print(f'wrote data to {pickle_path}')
+            voice.save(store_path)
+            print(f'wrote data to {store_path}.npy, {store_path}.json')
         except:
-            print(f'pickling to {pickle_path} failed')
+            print(f'saving to {store_path} failed')
             exit(-1)
         exit(0)
 
 
     print('=== PhonemeLoader query =================')
     try:
-        pickle_file = open(pickle_path, 'rb')
-        voice = pickle.load(pickle_file)
-        pickle_file.close()
+        voice = PhonemeMemLoader.load(store_path)
     except:
-        print('Depickling failed. Recreating dataset and pickling...')
+        print('Loading saved data failed. Recreating dataset and saving...')
         voice = PhonemeMemLoader(voice_path)
 
         try:
-            pickle_file = open(pickle_path, 'wb')
-            pickle.dump(voice, pickle_file)
-            pickle_file.close()
-            print(f'wrote data to {pickle_path}')
+            voice.save(store_path)
+            print(f'wrote data to {store_path}.npy, {store_path}.json')
         except:
-            print(f'pickling to {pickle_path} failed')
+            print(f'saving to {store_path} failed')
             exit(-1)
 
     # list all phonemes represented in dataset
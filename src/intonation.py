@@ -1,8 +1,23 @@
+import os
+import hashlib
+import zipfile
+from pathlib import Path
+
 import numpy as np
-from librosa import pyin, note_to_hz
+from librosa import pyin, note_to_hz, resample
+from numba import njit
 import phoneme, typemes
 from config import metric_config as config
 
+# pyin frame and hop lengths in samples at the f0 estimation rate
+# (at most config.py::f0_sample_rate), with hop = frame_length // 4
+FRAME_LENGTH = 512
+HOP_LENGTH = 128
+
+# pyin f0 search range, as note names
+FMIN = 'C2'
+FMAX = 'E4'
+
 def f0_heuristic(y: np.ndarray, sr: int, method: str | None = None) -> float:
     """
     Estiamtes the fundmental frequency differential in an
@@ -21,16 +36,69 @@ def f0_heuristic(y: np.ndarray, sr: int, method: str | None = None) -> float:
     if method == None:
         method = config['f0_heuristic']
 
-    if method == 'upspeak_coarse':
-        return upspeak_coarse(y, sr)
-    elif method == 'upspeak_fifths':
-        return upspeak_fifths(y, sr)
-    elif method == 'peak_to_peak':
-        return peak_to_peak(y, sr)
-    else:
+    heuristic = HEURISTICS.get(method)
+    if heuristic == None:
         print(f"Error: invalid method supplied")
         return -1
 
+    (f0, voiced_flag, voiced_prob) = f0_estimate(y, sr)
+    return heuristic(f0)
+
+def f0_heuristic_batch(y: np.ndarray, sr: int, starts: np.ndarray, ends: np.ndarray, method: str | None = None,
+        wav_file: Path | None = None) \
+        -> list[float]:
+    """
+    Estimates the fundamental frequency differential of several
+    segments of one audio signal, where segment i spans samples
+    starts[i] to ends[i]. The f0 track is estimated once over the
+    whole signal and each segment's metric is reduced from the
+    frames centred within it.
+    Accepts the same methods as f0_heuristic.
+    If y is the whole of wav_file, its f0 track is cached on disk
+    as per f0_estimate_cached.
+    """
+    if method == None:
+        method = config['f0_heuristic']
+
+    method_code = HEURISTIC_CODES.get(method)
+    if method_code == None:
+        print(f"Error: invalid method supplied")
+        return [-1.0 for _ in starts]
+
+    if wav_file != None and config['f0_cache']:
+        (f0, voiced_flag, voiced_prob) = f0_estimate_cached(y, sr, wav_file)
+    else:
+        (f0, voiced_flag, voiced_prob) = f0_estimate(y, sr)
+
+    # ceiling division: first frame centred at or after each bound,
+    # rescaling bounds from sr to the rate f0 was estimated at
+    f0_sr = min(sr, config['f0_sample_rate'])
+    frame_starts = -(-np.asarray(starts, dtype=np.int64) * f0_sr // (sr * HOP_LENGTH))
+    frame_ends = -(-np.asarray(ends, dtype=np.int64) * f0_sr // (sr * HOP_LENGTH))
+    return reduce_segments(method_code, f0, frame_starts, frame_ends).tolist()
+
+@njit(cache=True)
+def reduce_segments(method_code: int, f0: np.ndarray, frame_starts: np.ndarray, frame_ends: np.ndarray) \
+        -> np.ndarray:
+    """
+    Applies the *_from_f0 heuristic given by method_code (as per
+    HEURISTIC_CODES) to every f0[frame_starts[i]:frame_ends[i]]
+    segment in a single compiled loop.
+    The method is passed as a code rather than as the function
+    itself, as compiled functions type differently in every process
+    and would never hit the on-disk cache.
+    """
+    intonations = np.empty(len(frame_starts))
+    for i in range(len(frame_starts)):
+        segment = f0[frame_starts[i]:frame_ends[i]]
+        if method_code == UPSPEAK_COARSE:
+            intonations[i] = upspeak_coarse_from_f0(segment)
+        elif method_code == UPSPEAK_FIFTHS:
+            intonations[i] = upspeak_fifths_from_f0(segment)
+        else:
+            intonations[i] = peak_to_peak_from_f0(segment)
+    return intonations
+
 def f0_estimate(y, sr) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Wrapper for librosa.pyin Fundamental Frequency estimation.
@@ -42,17 +110,69 @@ def f0_estimate(y, sr) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     The pYIN algorithm then performs Viterbi decoding on YIN
     f0 estimates and their probabilities to estimate the
     most likely f0 sequence.
+
+    The searched f0 range is far below the Nyquist frequency of
+    config.py::f0_sample_rate, so y is first downsampled to that
+    rate if it is higher. Frames are HOP_LENGTH samples apart at
+    min(sr, f0_sample_rate).
     """
+    if sr > config['f0_sample_rate']:
+        y = resample(y, orig_sr=sr, target_sr=config['f0_sample_rate'])
+        sr = config['f0_sample_rate']
+
     return pyin(
         y=y,
-        fmin=note_to_hz('C2'),
-        fmax=note_to_hz('E4'),
+        fmin=note_to_hz(FMIN),
+        fmax=note_to_hz(FMAX),
         sr=sr,
         fill_na=None,
+        frame_length=FRAME_LENGTH,
+        hop_length=HOP_LENGTH,
         pad_mode='symmetric',
         # frame_length = int(np.min([2048, len(y)]))
     )
 
+def f0_estimate_cached(y: np.ndarray, sr: int, wav_file: Path) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    f0_estimate for y, the whole waveform of wav_file, cached in
+    .cache/<stem>.npz next to the wavfile. The cache is keyed on the
+    wavfile's path, size and modification time and on the pyin
+    parameters, and is recomputed whenever any of them change.
+    The cache is best-effort: failures to read or write it fall
+    back to estimating f0 directly.
+    """
+    wav_file = Path(wav_file).resolve()
+    cache_file = wav_file.parent.joinpath('.cache', f'{wav_file.stem}.npz')
+
+    stat = wav_file.stat()
+    key = hashlib.md5(str((
+        str(wav_file), stat.st_size, stat.st_mtime_ns, sr,
+        config['f0_sample_rate'], FRAME_LENGTH, HOP_LENGTH, FMIN, FMAX
+    )).encode()).hexdigest()
+
+    try:
+        with np.load(cache_file) as cached:
+            if str(cached['key']) == key:
+                return (cached['f0'], cached['voiced_flag'], cached['voiced_prob'])
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+
+    (f0, voiced_flag, voiced_prob) = f0_estimate(y, sr)
+
+    # write beside the cache file and rename over it, so concurrent
+    # loaders never read a partially written cache
+    try:
+        cache_file.parent.mkdir(exist_ok=True)
+        tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'wb') as f:
+            np.savez_compressed(f, key=key, f0=f0, voiced_flag=voiced_flag, voiced_prob=voiced_prob)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
+    return (f0, voiced_flag, voiced_prob)
+
 def upspeak_coarse(y, sr) -> float:
     """
     Coarsely estimates the change in fundamental frequency
@@ -60,9 +180,15 @@ def upspeak_coarse(y, sr) -> float:
     last and first voiced f0 estimates.
     """
     (f0, voiced_flag, voiced_prob) = f0_estimate(y, sr)
+    return upspeak_coarse_from_f0(f0)
 
-    # f0 = f0[np.where(voiced_flag == True)]
-    # f0 = f0[np.where(~np.isnan(f0))]
+@njit(cache=True)
+def upspeak_coarse_from_f0(f0: np.ndarray) -> float:
+    """
+    upspeak_coarse over an already estimated f0 sequence.
+    Frames without an f0 estimate (NaN) are ignored.
+    """
+    f0 = f0[~np.isnan(f0)]
     if len(f0) < 2: # segment too short for upspeak info
         return float('inf')
     return float(f0[-1] - f0[0])
@@ -75,13 +201,19 @@ def upspeak_fifths(y, sr) -> float:
     voiced f0 estimates.
     """
     (f0, voiced_flag, voiced_prob) = f0_estimate(y, sr)
+    return upspeak_fifths_from_f0(f0)
 
-    # f0 = f0[np.where(voiced_flag == True)]
-    # f0 = f0[np.where(~np.isnan(f0))]
+@njit(cache=True)
+def upspeak_fifths_from_f0(f0: np.ndarray) -> float:
+    """
+    upspeak_fifths over an already estimated f0 sequence.
+    Frames without an f0 estimate (NaN) are ignored.
+    """
+    f0 = f0[~np.isnan(f0)]
     if len(f0) < 2: # segment too short for upspeak info
         return float('inf')
     n = int(np.ceil(len(f0) / 5))
-    return float(np.average(f0[-n:]) - np.average(f0[:n]))
+    return float(np.mean(f0[-n:]) - np.mean(f0[:n]))
 
 def peak_to_peak(y, sr) -> float:
     """
@@ -89,9 +221,30 @@ def peak_to_peak(y, sr) -> float:
     voiced f0 estimates for an audio signal.
     """
     (f0, voiced_flag, voiced_prob) = f0_estimate(y, sr)
+    return peak_to_peak_from_f0(f0)
 
-    # f0 = f0[np.where(voiced_flag == True)]
-    # f0 = f0[np.where(~np.isnan(f0))]
+@njit(cache=True)
+def peak_to_peak_from_f0(f0: np.ndarray) -> float:
+    """
+    peak_to_peak over an already estimated f0 sequence.
+    Frames without an f0 estimate (NaN) are ignored.
+    """
+    f0 = f0[~np.isnan(f0)]
     if len(f0) < 2: # segment too short for upspeak info
         return float('inf')
-    return float(np.max(f0) - np.min(f0))
\ No newline at end of file
+    return float(np.max(f0) - np.min(f0))
+
+# *_from_f0 reduction for each f0_heuristic method
+HEURISTICS = {
+    'upspeak_coarse': upspeak_coarse_from_f0,
+    'upspeak_fifths': upspeak_fifths_from_f0,
+    'peak_to_peak': peak_to_peak_from_f0,
+}
+
+# reduce_segments code for each f0_heuristic method
+UPSPEAK_COARSE, UPSPEAK_FIFTHS, PEAK_TO_PEAK = 0, 1, 2
+HEURISTIC_CODES = {
+    'upspeak_coarse': UPSPEAK_COARSE,
+    'upspeak_fifths': UPSPEAK_FIFTHS,
+    'peak_to_peak': PEAK_TO_PEAK,
+}
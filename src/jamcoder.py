@@ -2,27 +2,43 @@ import argparse
 import sys
 import wave
 from pathlib import Path
+from functools import lru_cache
 
 import numpy as np
-import pickle
-from scipy.io.wavfile import write
 from g2p_en import G2p
 import nltk
 
 from dataloader import PhonemeLoader, PhonemeMemLoader, strip_stress
 from phoneme import Phoneme, PhonemeInstance
-from typemes import Typeme, standard_typeme_tree
+from typemes import Typeme, STANDARD_TYPEMES
 from choose import choose_phoneme
 from config import synth_config as config
 
+@lru_cache(maxsize=None)
+def get_g2p() \
+        -> G2p:
+    """
+    Returns the grapheme-to-phoneme converter, constructed on first
+    use, since constructing one loads its dictionary and model.
+    """
+    return G2p()
+
+@lru_cache(maxsize=512)
+def text_to_phonemes(text: str) \
+        -> tuple[str, ...]:
+    """
+    Returns the stressed phonemes of the passed text.
+    Memoised, so repeated texts skip grapheme-to-phoneme conversion.
+    """
+    return tuple(get_g2p()(text))
+
 def naive_synthesis(voice: PhonemeLoader, typemes: Typeme, target_text: str, method: str, debug: bool) \
         -> tuple[list[str], list[PhonemeInstance]]:
     """
     Returns a list of optimal source phoneme instances for
     the synthesis of the passed target text.
     """
-    g2p = G2p()
-    target_phonemes: list[str] = g2p(target_text)
+    target_phonemes: list[str] = list(text_to_phonemes(target_text))
     target_phonemes = ['' if p in typemes['silence'].child_names() else p for p in target_phonemes]
     target_phonemes = ['', *target_phonemes, '']
 
@@ -30,13 +46,12 @@ def naive_synthesis(voice: PhonemeLoader, typemes: Typeme, target_text: str, met
     if (debug):
         print(target_phonemes)
 
-    pre = ''
-    for i in range(len(target_phonemes)):
-        if i < len(target_phonemes) - 1:
-            nex = strip_stress(target_phonemes[i+1])
-        else:
-            nex = ''
-        curr = strip_stress(target_phonemes[i])
+    # strip every target phoneme once; each is then the current,
+    # the previous and the next phoneme of consecutive positions
+    stripped = [strip_stress(p) for p in target_phonemes]
+    pres = ['', *stripped[:-1]]
+    nexs = [*stripped[1:], '']
+    for curr, pre, nex in zip(stripped, pres, nexs):
         source_phonemes.append(
             choose_phoneme(
                 voice,
@@ -48,16 +63,27 @@ def naive_synthesis(voice: PhonemeLoader, typemes: Typeme, target_text: str, met
             )
         )
 
-        pre = curr
-
     return target_phonemes, source_phonemes
 
-def fade(t: int, length: int) \
-        -> tuple[float, float]:
+def fade(t: int | np.ndarray, length: int) \
+        -> tuple[float | np.ndarray, float | np.ndarray]:
+    """
+    Returns the linear crossfade gains of the previous and current
+    segments at sample t of a crossfade of the given length.
+    Accepts an array of samples to compute the whole ramp at once.
+    """
     prev_A, curr_A = ((length-t) / length, t / length)
 
     return prev_A, curr_A
 
+def to_pcm16(wav: np.ndarray) \
+        -> bytes:
+    """
+    Returns a float waveform as little-endian 16-bit PCM frames,
+    clipping rather than wrapping any overshoot.
+    """
+    return (np.clip(wav, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(prog='jamcoder')
@@ -82,32 +108,36 @@ if __name__ == '__main__':
     crossfade_overlap = args.crossfade_overlap
     outfile = args.outfile
 
-    nltk.download('averaged_perceptron_tagger_eng', quiet=not args.debug)
+    # only fetch the tagger when it is missing; nltk.download
+    # queries the package index on every call
+    try:
+        nltk.data.find('taggers/averaged_perceptron_tagger_eng')
+    except LookupError:
+        nltk.download('averaged_perceptron_tagger_eng', quiet=not args.debug)
 
     if crossfade_overlap < 0.0 or crossfade_overlap > 1.0:
         print(f'ERR: Crossfade overlap out of bounds! Must be between 0.0 and 1.0, Have {crossfade_overlap}')
         exit(-1)
 
-    data_path = Path(__file__).parent.parent.resolve().joinpath(Path('data'))
-    voice_path = data_path.joinpath(Path(voice))
-    pickle_path = data_path.joinpath(f'{Path(voice)}.pickle')
+    # the voice directory path doubles as the prefix of its saved voice
+    data_path = Path(__file__).parent.parent.resolve().joinpath('data')
+    voice_path = store_path = data_path.joinpath(voice)
 
     try:
-        pickle_file = open(pickle_path, 'rb')
-        voice = pickle.load(pickle_file)
-        pickle_file.close()
+        voice = PhonemeMemLoader.load(store_path)
     except:
-        print(f'no pickle file found at {pickle_path}. creating dataloader...')
+        print(f'no usable saved voice found at {store_path}.npy. creating dataloader...')
         voice = PhonemeMemLoader(voice_path)
-        pickle_file = open(pickle_path, 'wb')
-        pickle.dump(voice, pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
+        voice.save(store_path)
 
-    typemes = standard_typeme_tree()
+    typemes = STANDARD_TYPEMES
 
     method = 'dual_equality' if args.no_dual_similarity else 'dual_similarity'
     target_phonemes, source_phonemes = naive_synthesis(voice, typemes, target_text, method, args.debug)
 
-    synth_wav = np.array([])
+    # first pass: select each phoneme's samples and the previous samples
+    # it crossfades into, so the output can be allocated once
+    steps: list[tuple[np.ndarray | None, np.ndarray]] = []
     sr =  None
     for i in range(len(source_phonemes)):
         instance = source_phonemes[i]
@@ -116,12 +146,11 @@ if __name__ == '__main__':
             print(f'[{target_phonemes[i]}]: word {instance.word} interval {instance.interval}')
 
         (wav, sr), grid = voice.get_word_data(instance.word)
-
-        grid_i = grid['phonetic'][instance.interval]
+        wav_starts, wav_ends = voice.get_interval_bounds(instance.word)
 
         # select specific phoneme wav
-        wav_start = int(np.floor(sr * grid_i.xmin))
-        wav_end = int(np.floor(sr * grid_i.xmax))
+        wav_start = wav_starts[instance.interval]
+        wav_end = wav_ends[instance.interval]
         wav_length = wav_end - wav_start
 
         wav_seg = wav[wav_start:wav_end]
@@ -137,13 +166,12 @@ if __name__ == '__main__':
             try:
                 prev_instance = source_phonemes[i-1]
 
-                prev_grid_i = grid['phonetic'][prev_instance.interval]
+                prev_wav_start = wav_starts[prev_instance.interval]
+                prev_wav_end = wav_ends[prev_instance.interval]
             except IndexError:
-                synth_wav = np.concatenate((synth_wav, wav_seg))
+                steps.append((None, wav_seg))
                 continue
 
-            prev_wav_start = int(np.floor(sr * prev_grid_i.xmin))
-            prev_wav_end = int(np.floor(sr * prev_grid_i.xmax))
             prev_wav_length = prev_wav_end - prev_wav_start
 
             if prev_wav_length < wav_length:
@@ -153,17 +181,34 @@ if __name__ == '__main__':
 
             wav_overlap = wav_seg[0:crossfade_length]
 
-            # zero-pad to establish overlap buffer
-            zerobuf = np.zeros((int(np.floor((1-crossfade_overlap) * crossfade_length))))
-            wav_seg = np.concatenate((zerobuf, wav_seg))
-
-            for t in range(crossfade_length):
-                prev_A, curr_A = fade(t, crossfade_length)
-                synth_wav[len(synth_wav) - crossfade_length + t] *= prev_A
-                synth_wav[len(synth_wav) - crossfade_length + t] += \
-                    (wav_overlap[t] * curr_A)
-            synth_wav = np.concatenate((synth_wav, wav_seg[crossfade_length:]))
+            # zero-padding the segment by the overlap buffer and dropping its
+            # first crossfade_length samples leaves this much of it to append
+            zerobuf_length = int(np.floor((1-crossfade_overlap) * crossfade_length))
+            steps.append((wav_overlap, wav_seg[crossfade_length - zerobuf_length:]))
         else:
-            synth_wav = np.concatenate((synth_wav, wav_seg))
-
-    write(outfile, sr, synth_wav)
+            steps.append((None, wav_seg))
+
+    # second pass: crossfade each segment into the samples before it and
+    # stream the result to disk, holding back only as many samples as
+    # the longest crossfade can still reach
+    holdback = max((len(wav_overlap) for wav_overlap, _ in steps if wav_overlap is not None), default=0)
+    pending = np.zeros(0, dtype=np.float32)
+    with wave.open(outfile, 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(sr)
+
+        for wav_overlap, wav_seg in steps:
+            if wav_overlap is not None:
+                crossfade_length = len(wav_overlap)
+                prev_A, curr_A = fade(np.arange(crossfade_length, dtype=np.float32), crossfade_length)
+                pending_tail = pending[len(pending) - crossfade_length:]
+                pending_tail *= prev_A
+                pending_tail += wav_overlap * curr_A
+
+            pending = np.concatenate((pending, wav_seg))
+            if len(pending) > holdback:
+                out.writeframes(to_pcm16(pending[:len(pending) - holdback]))
+                pending = pending[len(pending) - holdback:]
+
+        out.writeframes(to_pcm16(pending))
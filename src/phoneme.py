@@ -2,6 +2,9 @@ from __future__ import annotations
 import intonation
 from typing import Self
 
+import numpy as np
+from typemes import Typeme
+
 class PhonemeInstance:
     """
     PhonemeInstance class stores:
@@ -47,10 +50,16 @@ class Phoneme:
     def __init__(
             self,
             name: str,
-            instances: list[PhonemeInstance] = []):
+            instances: list[PhonemeInstance] | None = None):
         self.name = name
-        self.instances = instances
-        self.num_instances = len(instances)
+        self.instances = [] if instances == None else instances
+        self.num_instances = len(self.instances)
+        self._arrays = None
+        self._both = None
+
+        self._by_word_interval = {}
+        for instance in self.instances:
+            self._by_word_interval.setdefault((instance.word, instance.interval), instance)
 
     def __len__(self) \
             -> int:
@@ -59,11 +68,7 @@ class Phoneme:
     def __getitem__(self, word_interval: tuple[string, int]) \
             -> PhonemeInstance | None:
         word, interval = word_interval
-
-        for i in range(self.num_instances):
-            if self.instances[i].word == word and self.instances[i].interval == interval:
-                return self.instances[i]
-        return None
+        return self._by_word_interval.get((word, interval))
 
     def append(self, instance: PhonemeInstance) \
             -> PhonemeInstance:
@@ -71,9 +76,76 @@ class Phoneme:
         Append PhonemeInstance to Phoneme.
         Returns the supplied PhonemeInstance.
         """
-        assert type(instance) == PhonemeInstance, \
-            f'"phoneme" argument must be of type Phoneme, received {type(instance)}'
+        assert isinstance(instance, PhonemeInstance), \
+            f'"instance" argument must be of type PhonemeInstance, received {type(instance)}'
 
         self.instances.append(instance)
         self.num_instances += 1
-        return PhonemeInstance
+        self._by_word_interval.setdefault((instance.word, instance.interval), instance)
+        self.invalidate()
+        return instance
+
+    def invalidate(self):
+        """
+        Drops the lookup tables built by context_arrays and
+        equality_candidates. Must be called whenever the pre or nex
+        of one of this Phoneme's instances changes.
+        """
+        self._arrays = None
+        self._both = None
+
+    def context_arrays(self, typemes: Typeme) \
+            -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the following arrays, aligned with instances:
+        (
+          previous phoneme typeme ids {np.ndarray[N] of int32},
+          next phoneme typeme ids {np.ndarray[N] of int32},
+          intonations {np.ndarray[N] of float64}
+        )
+        where typeme ids are as per Typeme.ids.
+        Computed on first use and kept until the next append or
+        invalidate.
+        """
+        if self._arrays == None or self._arrays[0] is not typemes:
+            self._arrays = (
+                typemes,
+                typemes.ids([instance.pre for instance in self.instances]),
+                typemes.ids([instance.nex for instance in self.instances]),
+                np.array([instance.intonation for instance in self.instances], dtype=np.float64)
+            )
+        return self._arrays[1:]
+
+    def equality_candidates(self, pre: str | None, nex: str | None) \
+            -> tuple[PhonemeInstance | None, PhonemeInstance | None,
+                     PhonemeInstance | None, PhonemeInstance | None]:
+        """
+        Returns the lowest intonation instance for each of:
+        (
+          matching previous and next phoneme,
+          matching previous phoneme,
+          matching next phoneme,
+          any
+        )
+        Candidates are not exclusive: a later candidate only excludes
+        the contexts of earlier ones when those earlier ones are None.
+        Indexed on first use and kept until the next append or
+        invalidate.
+        """
+        if self._both == None:
+            self._both, self._pre, self._nex, self._none = {}, {}, {}, None
+            for instance in self.instances:
+                both_key = (instance.pre, instance.nex)
+                for (index, key) in ((self._both, both_key),
+                        (self._pre, instance.pre), (self._nex, instance.nex)):
+                    if key not in index or index[key].intonation > instance.intonation:
+                        index[key] = instance
+                if self._none == None or self._none.intonation > instance.intonation:
+                    self._none = instance
+
+        return (
+            self._both.get((pre, nex)),
+            self._pre.get(pre),
+            self._nex.get(nex),
+            self._none
+        )
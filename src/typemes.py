@@ -1,4 +1,7 @@
 from __future__ import annotations
+from functools import lru_cache
+
+import numpy as np
 
 class Typeme:
     """
@@ -23,6 +26,12 @@ class Typeme:
         self.children = []
         for kid in spawn:
             self.children.append(Typeme(kid, depth+1, parent=self))
+
+        # lookup tables over this subtree, built on first use
+        self._index = None
+        self._positions = None
+        self._similarity = None
+        self._path = None
     
     def __getitem__(self, name: str) \
             -> Typeme:
@@ -30,27 +39,38 @@ class Typeme:
         Returns Typeme for queried typeme name if it corresponds to
         the queried typeme or any of its child typemes.
         Returns None otherwise.
+        Indexed on first use and kept until the subtree changes.
         """
-        if self.name == name:
-            return self
+        if self._index == None:
+            self._index = self._build_index()
+
+        return self._index.get(name)
 
-        for child in self.children:
-            if child[name] != None:
-                return child[name]
-        return None
+    def _build_index(self) \
+            -> dict[str, Typeme]:
+        """
+        Returns the name to Typeme index searched by __getitem__.
+        """
+        index = {}
+        for node in self.nodes():
+            index.setdefault(node.name, node)
+        return index
     
     def child_names(self) \
             -> list[str]:
         return [child.name for child in self.children]
     
     def set_depth(self, depth):
-        if self.depth == depth:
-            return
-        self.depth = depth
-        for child in self.children:
-            child.set_depth(depth+1)
+        stack = [(self, depth)]
+        while stack:
+            node, node_depth = stack.pop()
+            # a node already at its depth has a correctly numbered subtree
+            if node.depth == node_depth:
+                continue
+            node.depth = node_depth
+            stack.extend((child, node_depth+1) for child in node.children)
 
-    def adopt(self, children: list[Typeme] = []):
+    def adopt(self, children: list[Typeme] | tuple[Typeme] = ()):
         """
         Babyes
         """
@@ -58,7 +78,106 @@ class Typeme:
             child.parent = self
             child.set_depth(self.depth + 1)
             self.children.append(child)
+            for node in child.nodes():
+                node._path = None
+
+        # this subtree and every subtree containing it has changed
+        node = self
+        while node != None:
+            node._index, node._positions, node._similarity = None, None, None
+            node = node.parent
     
+    def nodes(self) \
+            -> list[Typeme]:
+        """
+        Returns this Typeme and all of its descendant Typemes,
+        in the same depth-first order searched by __getitem__.
+        """
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.children))
+        return nodes
+
+    def ids(self, names: list[str]) \
+            -> np.ndarray:
+        """
+        Returns the index into nodes() of the Typeme corresponding
+        to each queried typeme name, or -1 for empty or unknown names.
+        """
+        if self._positions == None:
+            self._positions = self._build_positions()
+
+        return np.array([self._positions.get(name, -1) if name else -1 for name in names],
+            dtype=np.int32)
+
+    def _build_positions(self) \
+            -> dict[str, int]:
+        """
+        Returns the name to nodes() index table searched by ids().
+        """
+        positions = {}
+        nodes = self.nodes()
+        for i in range(len(nodes)):
+            positions.setdefault(nodes[i].name, i)
+        return positions
+
+    def similarity_matrix(self) \
+            -> np.ndarray:
+        """
+        Returns a matrix S where S[i, j] is the similarity between
+        nodes()[i] and nodes()[j]. An extra last row and column hold
+        the similarity to a missing Typeme (-1), so S can be indexed
+        directly with the ids returned by ids().
+        Computed once and kept until the subtree changes.
+        """
+        if self._similarity is None:
+            self._similarity = self._build_similarity()
+        return self._similarity
+
+    def _build_similarity(self) \
+            -> np.ndarray:
+        """
+        Returns the matrix returned by similarity_matrix().
+        """
+        nodes = self.nodes()
+        position = {id(node): i for i, node in enumerate(nodes)}
+
+        # row i marks nodes()[i] and its ancestors, so rows dot to the
+        # number of shared ancestors: one more than their similarity
+        ancestry = np.zeros((len(nodes), len(nodes)), dtype=np.float32)
+        for i in range(len(nodes)):
+            node = nodes[i]
+            while node != self.parent:
+                ancestry[i, position[id(node)]] = 1
+                node = node.parent
+
+        similarity = np.full((len(nodes) + 1, len(nodes) + 1), -1, dtype=np.float32)
+        similarity[:-1, :-1] = ancestry @ ancestry.T - 1
+        return similarity
+
+    def path(self) \
+            -> tuple[Typeme, ...]:
+        """
+        Returns the Typemes from the top-level Typeme down to
+        and including this Typeme.
+        Computed on first use and kept until this Typeme or one
+        of its ancestors is adopted.
+        """
+        if self._path == None:
+            self._path = self._build_path()
+        return self._path
+
+    def _build_path(self) \
+            -> tuple[Typeme, ...]:
+        """
+        Returns the path returned by path().
+        """
+        parent_path = self.parent.path() if self.parent != None else ()
+        return (*parent_path, self)
+
     def similarity(self, other: Typeme) \
             -> int:
         """
@@ -71,31 +190,25 @@ class Typeme:
         """
         if other == None:
             return -1
-        
-        self_side, self_depth = self, self.depth
-        other_side, other_depth = other, other.depth
-
-        while self_depth > other_depth:
-            self_side = self_side.parent
-            self_depth -= 1
-        while other_depth > self_depth:
-            other_side = other_side.parent
-            other_depth -= 1
-        
-        while self_depth >= 0:
-            # print(f'{self_side.name} and {other_side.name}')
-            if self_side.name == other_side.name:
-                return self_depth
-            self_side = self_side.parent
-            other_side = other_side.parent
-            self_depth -= 1 
-
-        return -1
 
+        # the deepest shared Typeme ends the common prefix of both paths
+        shared = 0
+        for self_side, other_side in zip(self.path(), other.path()):
+            if self_side is not other_side:
+                break
+            shared += 1
+
+        if shared == 0:
+            return -1
+        return self.path()[shared - 1].depth
+
+@lru_cache(maxsize=None)
 def standard_typeme_tree() \
         -> Typeme:
     """
     Returns a hierarchical tree of phoneme types.
+    The tree and its lookup tables are built on the first call and the
+    same tree is returned thereafter, so it must not be modified.
     """
 
     front = Typeme(name='front', depth=2,
@@ -144,5 +257,22 @@ def standard_typeme_tree() \
     
     typemes = Typeme(name='phonemes', depth=0)
     typemes.adopt([vowels, diphthongs, semivowels, consonants])
-    
+
+    _build_tables(typemes)
     return typemes
+
+def _build_tables(typemes: Typeme):
+    """
+    Builds every lookup table of a finished Typeme tree up front,
+    rather than on first use.
+    """
+    typemes._index = typemes._build_index()
+    typemes._positions = typemes._build_positions()
+    typemes._similarity = typemes._build_similarity()
+    # nodes() lists parents before children, so each parent's
+    # path is already built when its children's paths are
+    for node in typemes.nodes():
+        node._path = node._build_path()
+
+# the standard tree, with its lookup tables built once at import
+STANDARD_TYPEMES = standard_typeme_tree()